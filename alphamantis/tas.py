@@ -1,11 +1,19 @@
 import argparse
+import functools
+import heapq
+import io
 import math
+import mmap
+import operator
 import re
+import string
 import sys
-from typing import Generator
+import time
+from typing import Generator, Optional, Tuple
 from collections import namedtuple
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 
@@ -17,6 +25,10 @@ class InvalidFileFormatError(Exception):
     pass
 
 
+_SETTINGS_LABELS = ('Start Date', 'Start Time', 'Run Number')
+_RIDER_LABEL_CHARS = frozenset(string.ascii_uppercase + '_')
+
+
 SpeedSensorRecord = namedtuple('SpeedSensorRecord',
                                ['timestamp',
                                 'value',
@@ -31,46 +43,217 @@ PowerSensorRecord = namedtuple('PowerSensorRecord',
                                 'elapsed_time'])
 
 
+@functools.lru_cache(maxsize=256)
+def _format_seconds(seconds: int) -> str:
+    return datetime.fromtimestamp(seconds).strftime('%F %T')
+
+
+def _format_timestamp(timestamp: float) -> str:
+    """
+    Format a UNIX timestamp like datetime.fromtimestamp(timestamp).strftime('%F %T.%f').
+
+    The date and time part is only formatted once per second.
+    """
+    seconds = math.floor(timestamp)
+    microseconds = round((timestamp - seconds) * 1e6)
+    if microseconds == 1000000:
+        seconds += 1
+        microseconds = 0
+    return f'{_format_seconds(seconds)}.{microseconds:06d}'
+
+
+def _split_setting(l: str) -> Optional[list]:
+    """
+    Split a '#\t\tlabel\tvalue...' settings line into its fields.
+    """
+    fields = l.rstrip('\r\n').split('\t')
+    if len(fields) < 4 or fields[0] != '#' or fields[1] != '' or not all(fields[2:]):
+        return None
+    return fields[2:]
+
+
+class _EntryPairing():
+    """
+    Pairs a sensor entry with the data entry TAS logs after it.
+
+    A usable sensor entry is taken together with the first of the following
+    data entries, and the next sensor entry is skipped as a copy. If last is
+    set, the data entries are collected up to the next sensor entry instead,
+    which completes the pair with the last of them and is skipped as a copy.
+    """
+    def __init__(self, last: bool = False):
+        self.last = last
+        self.entry = None
+        self.data = None
+        self.copy = False
+
+    def add_entry(self, entry, usable: bool) -> Optional[tuple]:
+        if self.copy:
+            self.copy = False
+        elif self.entry is None:
+            if usable:
+                self.entry = entry
+        elif self.data is not None:
+            pair = (self.entry, self.data)
+            self.entry = self.data = None
+            return pair
+        return None
+
+    def add_data(self, data) -> Optional[tuple]:
+        if self.entry is None:
+            return None
+        if not self.last:
+            pair = (self.entry, data)
+            self.entry = None
+            self.copy = True
+            return pair
+        self.data = data
+        return None
+
+    def close(self) -> Optional[tuple]:
+        if self.data is None:
+            return None
+        return (self.entry, self.data)
+
+
+def _local_datetime(timestamps: np.ndarray) -> pd.DatetimeIndex:
+    """
+    Convert UNIX timestamps to naive local time like datetime.fromtimestamp().
+
+    The UTC offset is looked up once per distinct minute.
+    """
+    minutes, inverse = np.unique(timestamps // 60, return_inverse=True)
+    offsets = np.array([time.localtime(x * 60).tm_gmtoff for x in minutes.tolist()], dtype=float)
+    return (pd.to_datetime(timestamps, unit='s').round('us')
+            + pd.to_timedelta(offsets[inverse.reshape(-1)], unit='s'))
+
+
 class DashboardRunLog():
     """
     Garmin Track Aero System dashboardRun log file parser.
     """
     def __init__(self, filename: str):
         self.filename = filename
+        self._settings = None
+        self._data_offset = 0
 
     @property
     def settings(self) -> dict:
-        with open(self.filename) as f:
+        if self._settings is None:
+            self._settings = self._read_settings()
+        return self._settings
+
+    def _read_settings(self) -> dict:
+        with open(self.filename, 'rb') as f:
             data = {}
+            section = None
             while True:
                 l = f.readline()
-                if not l or re.search(r'^#\tTime and Date', l):
-                    break
-            while True:
-                l = f.readline()
-                if not l or re.search(r'^###', l):
+                if not l:
                     break
-                m = re.search(r'^#\t\t(?P<label>Start Date|Start Time|Run Number):?\t(?P<value>[^\t]+)\n$', l)
-                if not m:
-                    continue
-                data[m.group('label').lower()] = m.group('value')
+                l = l.decode(errors='replace')
+                if l.startswith('#\tTime and Date'):
+                    section = 'time'
+                elif l.startswith('#\tRider and Device Data'):
+                    section = 'rider'
+                elif l.startswith('###'):
+                    # the rider section is the last one of the header
+                    if section == 'rider':
+                        self._data_offset = f.tell()
+                        break
+                    section = None
+                elif section:
+                    fields = _split_setting(l)
+                    if not fields:
+                        continue
+                    label = fields[0]
+                    if section == 'time':
+                        if label.endswith(':'):
+                            label = label[:-1]
+                        if len(fields) == 2 and label in _SETTINGS_LABELS:
+                            data[label.lower()] = fields[1]
+                    elif len(fields) in (2, 4) and _RIDER_LABEL_CHARS.issuperset(label):
+                        data[label.lower()] = tuple(fields[1:]) if len(fields) == 4 else fields[1]
+            return data
 
-            while True:
-                l = f.readline()
-                if not l or re.search(r'^#\tRider and Device Data', l):
-                    break
-            while True:
-                l = f.readline()
-                if not l or re.search(r'^###', l):
-                    break
-                m = re.search(r'^#\t\t(?P<label>[A-Z_]+)\t(?P<value>[^\t]+)(?:\t(?P<param1>[^\t]+)\t(?P<param2>[^\t]+))?\n$', l)
-                if not m:
-                    continue
-                if m.group('param1'):
-                    data[m.group('label').lower()] = (m.group('value'), m.group('param1'), m.group('param2'))
+    def _iter_rows_raw(self, sensors: Tuple[str, ...]) -> Generator[tuple, None, None]:
+        """
+        Scan the log once for the speed, cg_speed and power records.
+
+        Records of the requested sensors are yielded as plain
+        (sensor, timestamp, value, elapsed_time, count) tuples in the order
+        they are completed in the file. timestamp is the UNIX time float,
+        count is the wheel revolution count for speed and cg_speed and the
+        event count for power.
+        """
+        settings = self.settings
+        branches = []
+        # only the sensors requested need to be set up in the header
+        if 'speed' in sensors or 'cg_speed' in sensors:
+            _, speed_id = settings['speed'][0].split('_')
+            branches.append(('speed_entry', fr'([A-Z0-9]+_{speed_id}\t\d+\.\d+\tS\t0\t(\d+)\t(\d+)\t\t)'))
+            if 'speed' in sensors:
+                branches.append(('speed', fr'(SPEED\t[A-Z0-9]+_{speed_id}\t(\d+\.\d+)\t(\d+\.\d+)\r?\n)'))
+            if 'cg_speed' in sensors:
+                branches.append(('cg_speed', fr'(CG_SPEED_[A-Z0-9]+_{speed_id}\t(\d+\.\d+)\t(\d+\.\d+)\r?\n)'))
+        if 'power' in sensors:
+            _, power_id = settings['power'][0].split('_')
+            branches.append(('power_entry', fr'([A-Z0-9]+_{power_id}\t\d+\.\d+\tS\t(\d+)\t(\d+)\t\d+\t\d+\t)'))
+            branches.append(('power', fr'(POWER\t[A-Z0-9]+_{power_id}\t(\d+\.\d+)\t(\d+\.\d+)\r?\n)'))
+        # the record group of a branch is the last one closed, so lastindex
+        # tells the branches apart. its two fields are the groups right after it
+        kinds = {}
+        index = 1
+        for kind, branch in branches:
+            kinds[index] = kind
+            index += re.compile(branch).groups
+        pattern = re.compile(('(?m)^(?:' + '|'.join(x for _, x in branches) + ')').encode())
+
+        def speed_row(pair, sensor):
+            (timer, count), (timestamp, value) = pair
+            return (sensor, float(timestamp), float(value), int(timer) / 1024, int(count))
+
+        def power_row(pair):
+            (event_count, elapsed_time), (timestamp, value) = pair
+            return ('power', float(timestamp), float(value), int(elapsed_time) * 0.0005, int(event_count))
+
+        speed, cg_speed, power = _EntryPairing(), _EntryPairing(last=True), _EntryPairing()
+        with open(self.filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for m in pattern.finditer(mm, self._data_offset):
+                i = m.lastindex
+                kind = kinds[i]
+                fields = m.group(i + 1, i + 2)
+                if kind == 'speed_entry':
+                    usable = int(fields[0]) != 0
+                    speed.add_entry(fields, usable)
+                    pair = cg_speed.add_entry(fields, usable)
+                    if pair:
+                        yield speed_row(pair, 'cg_speed')
+                elif kind == 'speed':
+                    pair = speed.add_data(fields)
+                    if pair:
+                        yield speed_row(pair, 'speed')
+                elif kind == 'cg_speed':
+                    cg_speed.add_data(fields)
+                elif kind == 'power_entry':
+                    power.add_entry(fields, fields[0] != b'0')
                 else:
-                    data[m.group('label').lower()] = m.group('value')
-            return data
+                    pair = power.add_data(fields)
+                    if pair:
+                        yield power_row(pair)
+
+        pair = cg_speed.close()
+        if pair:
+            yield speed_row(pair, 'cg_speed')
+
+    def _speed_records(self, sensors: Tuple[str, ...]) -> Generator[Tuple[str, SpeedSensorRecord], None, None]:
+        circumference = float(self.settings['speed'][1])
+        for sensor, timestamp, value, elapsed_time, count in self._iter_rows_raw(sensors):
+            yield sensor, SpeedSensorRecord(datetime.fromtimestamp(timestamp),
+                                            value,
+                                            elapsed_time,
+                                            count,
+                                            circumference)
 
     def speed(self) -> Generator[SpeedSensorRecord, None, None]:
         """
@@ -79,98 +262,18 @@ class DashboardRunLog():
         ANT+ will continue to transmit the same value while the sensor
         is updated, so only updated values are retrieved
         """
-        settings = self.settings
-        _, sensor_id = settings['speed'][0].split('_')
-        circumference = float(settings['speed'][1])
-
-        pattern = fr'^[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\tS\t0\t(?P<timer>\d+)\t(?P<count>\d+)\t\t'
-        next_pattern = fr'^SPEED\t[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\t(?P<speed>\d+\.\d+)\n'
-        with open(self.filename) as f:
-            while True:
-                l = f.readline()
-                if not l:
-                    break
-                # find first entry
-                m = re.search(pattern, l)
-                if not m:
-                    continue
-                rev_count = int(m.group('count'))
-                meas_time = int(m.group('timer'))
-                if meas_time == 0:
-                    continue
-                speed = round(circumference * rev_count * 1024 / meas_time, 6) if meas_time > 0 else 0.0
-
-                # find data entry
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    m = re.search(next_pattern, l)
-                    if not m:
-                        continue
-
-                    result = SpeedSensorRecord(datetime.fromtimestamp(float(m.group('timestamp'))),
-                                               float(m.group('speed')),
-                                               round(meas_time / 1024, 6),
-                                               rev_count,
-                                               circumference)
-                    break
-
-                # seek next copy
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    if re.search(pattern, l):
-                        break
-                yield result
+        for _, record in self._speed_records(('speed',)):
+            yield record
 
     def power(self) -> Generator[PowerSensorRecord, None, None]:
         """
         Generator to get the first value of the ANT+ bicycle Power sensor.
         """
-        settings = self.settings
-        _, sensor_id = settings['power'][0].split('_')
-        offset = int(settings['power'][1])
-
-        pattern = fr'^[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\tS\t(?P<event_count>\d+)\t(?P<elapsed_time>\d+)\t(?P<torque_ticks>\d+)\t(?P<slope>\d+)\t'
-        next_pattern = fr'^POWER\t[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\t(?P<power>\d+\.\d+)\n'
-        with open(self.filename) as f:
-            while True:
-                l = f.readline()
-                if not l:
-                    break
-                # find first entry
-                m = re.search(pattern, l)
-                if not m or m.group('event_count') == '0':
-                    continue
-
-                event_count = int(m.group('event_count'))
-                elapsed_time = int(m.group('elapsed_time')) * 0.0005
-                # find power entry
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    m = re.search(next_pattern, l)
-                    if not m:
-                        continue
-
-                    timestamp = datetime.fromtimestamp(float(m.group('timestamp')))
-                    power = float(m.group('power'))
-                    result = PowerSensorRecord(timestamp,
-                                           power,
-                                           event_count,
-                                           round(elapsed_time, 6))
-                    break
-                # skip to next copy entry
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    if re.search(pattern, l):
-                        break
-                yield result
+        for _, timestamp, value, elapsed_time, event_count in self._iter_rows_raw(('power',)):
+            yield PowerSensorRecord(datetime.fromtimestamp(timestamp),
+                                    value,
+                                    event_count,
+                                    elapsed_time)
 
     def cg_speed(self) -> Generator[SpeedSensorRecord, None, None]:
         """
@@ -183,78 +286,55 @@ class DashboardRunLog():
 
         NOTE: もしかしたら平均値を返すべきか？
         """
-        settings = self.settings
-        _, sensor_id = settings['speed'][0].split('_')
-        circumference = float(settings['speed'][1])
+        for _, record in self._speed_records(('cg_speed',)):
+            yield record
 
-        pattern = fr'^[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\tS\t0\t(?P<timer>\d+)\t(?P<count>\d+)\t\t'
-        next_pattern = fr'^CG_SPEED_[A-Z0-9]+_{sensor_id}\t(?P<timestamp>\d+\.\d+)\t(?P<speed>\d+\.\d+)\n'
-        latest = None
-        with open(self.filename) as f:
-            while True:
-                l = f.readline()
-                if not l:
-                    break
-                # find first entry
-                m = re.search(pattern, l)
-                if not m:
-                    continue
-                rev_count = int(m.group('count'))
-                meas_time = int(m.group('timer'))
-                if meas_time == 0:
-                    continue
-                # find latest data entry
-                result = None
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    if result and re.search(pattern, l):
-                        break
-                    m = re.search(next_pattern, l)
-                    if not m:
-                        continue
-                    result = SpeedSensorRecord(datetime.fromtimestamp(float(m.group('timestamp'))),
-                                               float(m.group('speed')),
-                                               round(meas_time / 1024, 6),
-                                               rev_count,
-                                               circumference)
-                if result is None:
-                    break
-                yield result
+    def speed_and_cg_speed(self) -> Generator[Tuple[str, SpeedSensorRecord], None, None]:
+        """
+        Generator to get both speed() and cg_speed() values in a single pass.
 
+        Both share the ANT+ Bicycle Speed sensor entries, so the file is only
+        scanned once. Values are yielded as ('speed' or 'cg_speed', record)
+        in the order they appear in the log.
+        """
+        yield from self._speed_records(('speed', 'cg_speed'))
 
     def to_df(self) -> pd.DataFrame:
-        speed = list(self.speed())
-        v = pd.DataFrame({'sensor': ['speed' for x in speed],
-                          'value': [x.value for x in speed],
-                          'elapsed_time': [x.elapsed_time for x in speed]},
-                         index=[x.timestamp.strftime('%F %T.%f') for x in speed])
-        cg_speed = list(self.cg_speed())
-        vcg = pd.DataFrame({'sensor': ['cg_speed' for x in cg_speed],
-                            'value': [x.value for x in cg_speed],
-                            'elapsed_time': [x.elapsed_time for x in cg_speed]},
-                           index=[x.timestamp.strftime('%F %T.%f') for x in cg_speed])
-        power = list(self.power())
-        w = pd.DataFrame({'sensor': ['power' for x in power],
-                          'value': [x.value for x in power],
-                          'elapsed_time': [x.elapsed_time for x in power]},
-                         index=[x.timestamp.strftime('%F %T.%f') for x in power])
-        df = pd.concat([v, vcg, w])
-        df.index = pd.to_datetime(df.index)
-        return df
+        # the frame lists speed rows first, then cg_speed and power rows
+        rows = {'speed': [], 'cg_speed': [], 'power': []}
+        for row in self._iter_rows_raw(tuple(rows)):
+            rows[row[0]].append(row)
+        rows = rows['speed'] + rows['cg_speed'] + rows['power']
+        sensors, timestamps, values, elapsed_times, _ = zip(*rows) if rows else ((),) * 5
+        return pd.DataFrame({'sensor': sensors,
+                             'value': np.array(values, dtype=float),
+                             'elapsed_time': np.array(elapsed_times, dtype=float)},
+                            index=_local_datetime(np.array(timestamps, dtype=float)))
 
 
 def main():
     args = parser.parse_args()
     log = DashboardRunLog(args.file)
-    speed, power = log.speed(), log.power()
-
-    records = list(speed) + list(power)
-    records = sorted(records, key=lambda x: x.timestamp)
-    csv = [f'{x.timestamp.strftime("%F %T.%f")},{"power" if isinstance(x, PowerSensorRecord) else "speed"},{x.value:.6f},{x.elapsed_time:.6f}' for x in records]
-    print("timestamp,sensor,value,elapsed_time")
-    print("\n".join(csv))
+    # both streams are in timestamp order already, so they are merged lazily.
+    # each has its own scan, so neither is buffered while the other lags behind
+    speed = log._iter_rows_raw(('speed',))
+    power = log._iter_rows_raw(('power',))
+
+    # sys.stdout flushes every line on a terminal, so rows are written
+    # through a block buffered wrapper of the same binary stream
+    stdout = sys.stdout
+    if hasattr(stdout, 'buffer'):
+        stdout.flush()
+        stdout = io.TextIOWrapper(sys.stdout.buffer, encoding=sys.stdout.encoding, errors=sys.stdout.errors)
+    try:
+        out = stdout.write
+        out("timestamp,sensor,value,elapsed_time\n")
+        for sensor, timestamp, value, elapsed_time, _ in heapq.merge(speed, power, key=operator.itemgetter(1)):
+            out(f'{_format_timestamp(timestamp)},{sensor},{value:.6f},{elapsed_time:.6f}\n')
+    finally:
+        if stdout is not sys.stdout:
+            stdout.detach()
+        sys.stdout.flush()
     print(log.settings, file=sys.stderr)
 
 
@@ -0,0 +1,164 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from alphamantis import tas
+from alphamantis.tas import DashboardRunLog
+
+
+HEADER = ('# Dashboard run log\n'
+          '#\tTime and Date\n'
+          '#\t\tStart Date:\t2022-05-01\n'
+          '#\t\tStart Time:\t10:11:12\n'
+          '#\t\tRun Number:\t7\n'
+          '#\t\tTime Zone:\tUTC\n'
+          '###\n'
+          '#\tRider and Device Data\n'
+          '#\t\tRIDER_NAME\tFoo\n'
+          '#\t\tRIDER_TEAM\t\n'
+          '#\t\trider_mass\t80\n'
+          '#\t\tSPEED\tANTS_12345\t2.096\t0\n'
+          '#\t\tPOWER\tANTP_23456\t0\t0\n'
+          '###\n'
+          '#\tData\n'
+          '#\t\tRIDER_MASS\t80\n')
+
+SETTINGS = {'start date': '2022-05-01',
+            'start time': '10:11:12',
+            'run number': '7',
+            'rider_name': 'Foo',
+            'speed': ('ANTS_12345', '2.096', '0'),
+            'power': ('ANTP_23456', '0', '0')}
+
+MIXED_BODY = ('ANTS_12345\t1651367472.050\tS\t0\t891\t1\t\t7\n'
+              'SPEED\tANTS_12345\t1651367472.051\t12.361226\n'
+              'CG_SPEED_ANTS_12345\t1651367472.051\t13.943617\n'
+              'CG_SPEED_ANTS_12345\t1651367472.051\t10.469298\n'
+              'ANTS_12345\t1651367472.052\tS\t0\t891\t1\t\t7\n'
+              'ANTP_23456\t1651367472.151\tS\t1\t890\t0\t44\t3\n'
+              'POWER\tANTP_23456\t1651367472.151\t370.428237\n'
+              'ANTP_23456\t1651367472.152\tS\t1\t890\t0\t44\t3\n'
+              'OTHER_1\t1651367472.160\tfoo\n'
+              'ANTS_12345\t1651367472.201\tS\t0\t1404\t2\t\t6\n'
+              'SPEED\tANTS_12345\t1651367472.202\t5\n'
+              'SPEED\tANTS_12345\t1651367472.203\t14.845203\textra\n'
+              'CG_SPEED_ANTS_12345\t1651367472.203\t15.102938\n'
+              'ANTS_12345\t1651367472.204\tS\t0\t1404\t2\t\t6\n'
+              'ANTP_23456\t1651367472.252\tS\t2\t1781\t0\t80\t3\n'
+              'ANTS_12345\t1651367472.301\tS\t0\t1917\t3\t\t6\n'
+              'SPEED\tANTS_12345\t1651367472.302\t15.221038')
+
+
+class DashboardRunLogTest(unittest.TestCase):
+    def write_log(self, body: str, newline: str = '\n', header: str = HEADER) -> DashboardRunLog:
+        fd, filename = tempfile.mkstemp(suffix='.log')
+        self.addCleanup(os.remove, filename)
+        with os.fdopen(fd, 'w', newline=newline) as f:
+            f.write(header + body)
+        return DashboardRunLog(filename)
+
+    def assert_df_matches_generators(self, log: DashboardRunLog):
+        df = log.to_df()
+        for sensor, records in [('speed', log.speed()),
+                                ('cg_speed', log.cg_speed()),
+                                ('power', log.power())]:
+            rows = df[df.sensor == sensor]
+            self.assertEqual([(x.timestamp, x.value, x.elapsed_time) for x in records],
+                             list(zip(rows.index.to_pydatetime(), rows.value, rows.elapsed_time)))
+
+    def test_settings(self):
+        for newline in ('\n', '\r\n'):
+            with self.subTest(newline=repr(newline)):
+                self.assertEqual(self.write_log(MIXED_BODY, newline).settings, SETTINGS)
+
+    def test_speed_skips_entry_copy(self):
+        log = self.write_log('ANTS_12345\t1.0\tS\t0\t1024\t10\t\t1\n'
+                             'SPEED\tANTS_12345\t5.0\t1.0\n'
+                             'ANTS_12345\t1.1\tS\t0\t1024\t10\t\t1\n'
+                             'ANTS_12345\t2.0\tS\t0\t2048\t11\t\t1\n'
+                             'SPEED\tANTS_12345\t6.0\t2.0\n'
+                             'ANTS_12345\t2.1\tS\t0\t2048\t11\t\t1\n')
+        self.assertEqual([(x.timestamp.timestamp(), x.value, x.elapsed_time, x.count) for x in log.speed()],
+                         [(5.0, 1.0, 1.0, 10), (6.0, 2.0, 2.0, 11)])
+        self.assert_df_matches_generators(log)
+
+    def test_generators_need_only_their_sensor_settings(self):
+        body = ('ANTS_12345\t1.0\tS\t0\t1024\t10\t\t1\n'
+                'SPEED\tANTS_12345\t1.0\t1.0\n'
+                'CG_SPEED_ANTS_12345\t1.0\t1.1\n'
+                'ANTP_23456\t1.5\tS\t1\t890\t0\t44\t3\n'
+                'POWER\tANTP_23456\t1.5\t370.0\n'
+                'ANTS_12345\t1.6\tS\t0\t1024\t10\t\t1\n'
+                'ANTS_12345\t2.0\tS\t0\t2048\t11\t\t1\n'
+                'SPEED\tANTS_12345\t2.0\t2.0\n')
+        log = self.write_log(body, header=HEADER.replace('#\t\tPOWER\tANTP_23456\t0\t0\n', ''))
+        self.assertNotIn('power', log.settings)
+        self.assertEqual([x.value for x in log.speed()], [1.0, 2.0])
+        self.assertEqual([x.value for x in log.cg_speed()], [1.1])
+        log = self.write_log(body, header=HEADER.replace('#\t\tSPEED\tANTS_12345\t2.096\t0\n', ''))
+        self.assertNotIn('speed', log.settings)
+        self.assertEqual([x.value for x in log.power()], [370.0])
+
+    def test_to_df_matches_generators(self):
+        for newline in ('\n', '\r\n'):
+            with self.subTest(newline=repr(newline)):
+                log = self.write_log(MIXED_BODY, newline)
+                self.assertEqual(log.to_df().sensor.value_counts().to_dict(),
+                                 {'speed': 1, 'cg_speed': 2, 'power': 1})
+                self.assert_df_matches_generators(log)
+
+    def test_speed_and_cg_speed_matches_generators(self):
+        log = self.write_log(MIXED_BODY)
+        records = list(log.speed_and_cg_speed())
+        self.assertEqual([x for sensor, x in records if sensor == 'speed'], list(log.speed()))
+        self.assertEqual([x for sensor, x in records if sensor == 'cg_speed'], list(log.cg_speed()))
+        self.assertEqual({sensor for sensor, _ in records}, {'speed', 'cg_speed'})
+
+    def test_main_writes_csv(self):
+        # the speed and power records at .500 tie, and .9999996 rounds up to the next second
+        log = self.write_log('ANTS_12345\t1651367472.400\tS\t0\t1024\t10\t\t1\n'
+                             'SPEED\tANTS_12345\t1651367472.500\t12.5\n'
+                             'ANTP_23456\t1651367472.450\tS\t1\t890\t0\t44\t3\n'
+                             'POWER\tANTP_23456\t1651367472.500\t370.25\n'
+                             'ANTS_12345\t1651367472.501\tS\t0\t1024\t10\t\t1\n'
+                             'ANTP_23456\t1651367472.502\tS\t1\t890\t0\t44\t3\n'
+                             'ANTS_12345\t1651367472.900\tS\t0\t2048\t11\t\t1\n'
+                             'SPEED\tANTS_12345\t1651367472.9999996\t13.0\n'
+                             'ANTS_12345\t1651367473.001\tS\t0\t2048\t11\t\t1\n'
+                             'ANTP_23456\t1651367473.100\tS\t2\t1781\t0\t80\t3\n'
+                             'POWER\tANTP_23456\t1651367473.200\t303.0\n')
+        expected = ('timestamp,sensor,value,elapsed_time\n'
+                    '2022-05-01 01:11:12.500000,speed,12.500000,1.000000\n'
+                    '2022-05-01 01:11:12.500000,power,370.250000,0.445000\n'
+                    '2022-05-01 01:11:13.000000,speed,13.000000,2.000000\n'
+                    '2022-05-01 01:11:13.200000,power,303.000000,0.890500\n')
+
+        environ = mock.patch.dict(os.environ, {'TZ': 'UTC'})
+        environ.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(environ.stop)
+        self.addCleanup(tas._format_seconds.cache_clear)
+        time.tzset()
+        tas._format_seconds.cache_clear()
+
+        for buffered in (True, False):
+            with self.subTest(buffered=buffered):
+                stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8') if buffered else io.StringIO()
+                with mock.patch.object(sys, 'argv', ['tas', log.filename]), \
+                        contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+                    tas.main()
+                self.assertEqual(stdout.buffer.getvalue().decode() if buffered else stdout.getvalue(), expected)
+
+    def test_to_df_without_records(self):
+        log = self.write_log('OTHER_1\t1.0\tfoo\n')
+        self.assertTrue(log.to_df().empty)
+        self.assert_df_matches_generators(log)
+
+
+if __name__ == '__main__':
+    unittest.main()